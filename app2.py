@@ -1,33 +1,20 @@
 import streamlit as st
-import pandas as pd
-import plotly.express as px
 import plotly.graph_objects as go
 import numpy as np
 
+from cot_core import (
+    COL_MARKET, COL_DATE, COL_NC_L, COL_NC_S, COL_C_L, COL_C_S, DATA_PATH,
+    load_data, get_markets, get_year_range, split_by_market, slice_years,
+    compute_mom, compute_lines, compute_kpis,
+)
+
 st.set_page_config(page_title="COT – Netos y Variación Mensual", layout="wide")
 st.title("COT – Posiciones Netas y Variación Mensual (CME)")
 
-# -------------------- Carga de datos --------------------
-@st.cache_data
-def load_data(path: str = "CME.xlsx") -> pd.DataFrame:
-    df = pd.read_excel(path, engine="openpyxl")
-    df.columns = [str(c).replace("\n", " ").strip() for c in df.columns]
-    if "As of Date in Form YYYY-MM-DD" in df.columns:
-        df["As of Date in Form YYYY-MM-DD"] = pd.to_datetime(
-            df["As of Date in Form YYYY-MM-DD"], errors="coerce", dayfirst=True
-        )
-    return df
-
-df = load_data()
-
-# -------------------- Columnas esperadas --------------------
-COL_MARKET = "Market and Exchange Names"
-COL_DATE   = "As of Date in Form YYYY-MM-DD"
-COL_NC_L   = "Noncommercial Positions-Long (All)"
-COL_NC_S   = "Noncommercial Positions-Short (All)"
-COL_C_L    = "Commercial Positions-Long (All)"
-COL_C_S    = "Commercial Positions-Short (All)"
+data_key = (str(DATA_PATH), DATA_PATH.stat().st_mtime)
+df = load_data(*data_key)
 
+# -------------------- Validación de columnas --------------------
 need = [COL_MARKET, COL_DATE, COL_NC_L, COL_NC_S, COL_C_L, COL_C_S]
 missing = [c for c in need if c not in df.columns]
 if missing:
@@ -35,192 +22,214 @@ if missing:
     st.stop()
 
 # -------------------- Sidebar: filtros --------------------
-markets = sorted(df[COL_MARKET].dropna().unique().tolist())
+markets = get_markets(*data_key)
 sel_market = st.sidebar.selectbox("🔎 Mercado", markets, index=0)
 
-all_years = sorted(df[COL_DATE].dt.year.dropna().astype(int).unique().tolist())
-y_min, y_max = int(min(all_years)), int(max(all_years))
+y_min, y_max = get_year_range(*data_key)
 default_start = max(y_min, y_max - 1) if y_max > y_min else y_min
 sel_years = st.sidebar.slider("📅 Rango de años", min_value=y_min, max_value=y_max,
                               value=(default_start, y_max), step=1)
 
-df_plot = df[(df[COL_MARKET] == sel_market) &
-             (df[COL_DATE].dt.year.between(sel_years[0], sel_years[1]))].copy()
-df_plot = df_plot.sort_values(COL_DATE)
+df_plot = slice_years(split_by_market(*data_key)[sel_market], *sel_years)
 
 if df_plot.empty:
     st.info("No hay datos para el mercado/años seleccionado(s).")
     st.stop()
 
-# -------------------- Derivados (netos) --------------------
-df_plot["NC Net"] = df_plot[COL_NC_L] - df_plot[COL_NC_S]
-df_plot["C Net"]  = df_plot[COL_C_L]  - df_plot[COL_C_S]
-
 # -------------------- Utilidades de sentimiento --------------------
+# Tablas de (etiqueta, color) indexadas por np.select: sirven igual para un valor
+# suelto (tarjetas) que para una serie completa
+DIRECTION_LABELS = np.array(["Bajista", "Neutral", "Alcista"])
+DIRECTION_COLORS = np.array(["#c0392b", "#808080", "#0ea65d"])
+
+def direction_vec(nc, eps: float = 1e-9) -> tuple[np.ndarray, np.ndarray]:
+    """Alcista / Bajista / Neutral + color para cada valor de NC Net (NaN -> Neutral)."""
+    nc = np.asarray(nc, dtype=np.float64)
+    idx = np.select([nc > eps, nc < -eps], [2, 0], default=1)
+    return DIRECTION_LABELS[idx], DIRECTION_COLORS[idx]
+
 def direction_from_nc(nc_now: float, eps: float = 1e-9) -> tuple[str, str]:
     """Alcista / Bajista / Neutral (según signo de NC Net) + color."""
-    if nc_now > eps:
-        return "Alcista", "#0ea65d"
-    if nc_now < -eps:
-        return "Bajista", "#c0392b"
-    return "Neutral", "#808080"
+    labels, colors = direction_vec([nc_now], eps)
+    return str(labels[0]), str(colors[0])
 
 # Umbrales para intensidad (puedes ajustarlos si prefieres)
 INT_LOW = 10.0   # <10% -> Bajo
 INT_MED = 25.0   # 10–25% -> Medio
 # >=25% -> Alto
+INTENSITY_LABELS = np.array(["Bajo", "Medio", "Alto"])
+INTENSITY_COLORS = np.array(["#7f8c8d", "#f39c12", "#8e44ad"])
+
+def intensity_vec(pct_abs) -> tuple[np.ndarray, np.ndarray]:
+    """Bajo / Medio / Alto + color para cada |% cambio| (NaN -> Bajo, por defecto)."""
+    pct_abs = np.asarray(pct_abs, dtype=np.float64)
+    idx = np.select([np.isnan(pct_abs), pct_abs < INT_LOW, pct_abs < INT_MED], [0, 0, 1], default=2)
+    return INTENSITY_LABELS[idx], INTENSITY_COLORS[idx]
 
 def intensity_from_pct(delta_pct_abs: float | None) -> tuple[str, str]:
     """Bajo / Medio / Alto por magnitud del % cambio en 4 semanas (abs)."""
-    if delta_pct_abs is None or pd.isna(delta_pct_abs):
-        return "Bajo", "#7f8c8d"  # por defecto
-    if delta_pct_abs < INT_LOW:
-        return "Bajo", "#7f8c8d"
-    if delta_pct_abs < INT_MED:
-        return "Medio", "#f39c12"
-    return "Alto", "#8e44ad"
+    labels, colors = intensity_vec([np.nan if delta_pct_abs is None else delta_pct_abs])
+    return str(labels[0]), str(colors[0])
+
+# Tarjeta de color: se rellena con .format() en cada rerun
+CARD_HTML = """
+<div style="
+    padding:14px 18px;
+    border-radius:14px;
+    background:{color}22;
+    border:1px solid {color};
+">
+    <div style="font-weight:700; font-size:18px; color:{color};">
+        {title}
+    </div>
+    <div style="color:#555; margin-top:4px;">
+        {body}
+    </div>
+</div>
+"""
 
 # -------------------- KPIs + Tarjetas de sentimiento --------------------
 st.subheader(f"{sel_market} – {sel_years[0]}–{sel_years[1]}")
 
-last = df_plot.iloc[-1]
-if len(df_plot) >= 2:
-    prev = df_plot.iloc[-2]
-else:
-    prev = None
-
-# Cambio 4 semanas para NC Net (aprox. 4 reportes)
-if len(df_plot) >= 5:
-    nc_net_4w = df_plot.iloc[-5]["NC Net"]
-    nc_delta_abs = last["NC Net"] - nc_net_4w
-    denom = max(1.0, abs(nc_net_4w))
-    nc_delta_pct = (nc_delta_abs / denom) * 100.0
-else:
-    nc_net_4w = np.nan
-    nc_delta_abs = np.nan
-    nc_delta_pct = np.nan
+# Últimas 2 filas de los KPIs, cacheadas por mercado y años (cambio 4 semanas de
+# NC Net ya precalculado, NaN si el reporte de hace 4 semanas queda fuera del rango)
+kpi, last_date = compute_kpis(*data_key, sel_market, *sel_years)
+nc_net, c_net, nc_long, nc_short, c_long, c_short, nc_delta_abs, nc_delta_pct = kpi[-1]
+prev = kpi[-2] if len(kpi) >= 2 else None
+
+def fmt_int(v: float) -> str:
+    """Entero con separador de miles; '—' si el dato falta (NaN)."""
+    return "—" if np.isnan(v) else f"{int(v):,}"
+
+def delta_int(now: float, prev_val: float | None) -> int | None:
+    """Cambio frente al reporte previo; None si no hay previo o falta alguno de los datos."""
+    if prev_val is None or np.isnan(now - prev_val):
+        return None
+    return int(now - prev_val)
 
 # Fila 1: KPIs Netos y Tarjetas
 c1, c2, c3, c4 = st.columns([1, 1, 1.2, 1.2])
 
-with c1:
-    if prev is not None:
-        st.metric("NC Net", f"{int(last['NC Net']):,}", int(last["NC Net"] - prev["NC Net"]))
-    else:
-        st.metric("NC Net", f"{int(last['NC Net']):,}")
-
-with c2:
-    if prev is not None:
-        st.metric("C Net", f"{int(last['C Net']):,}", int(last["C Net"] - prev["C Net"]))
-    else:
-        st.metric("C Net", f"{int(last['C Net']):,}")
+prev_nc, prev_c = (None, None) if prev is None else prev[:2]
+c1.metric("NC Net", fmt_int(nc_net), delta_int(nc_net, prev_nc))
+c2.metric("C Net", fmt_int(c_net), delta_int(c_net, prev_c))
 
 # Tarjeta 1: Sentimiento (según NC Net)
-dir_label, dir_color = direction_from_nc(last["NC Net"])
+dir_label, dir_color = direction_from_nc(nc_net)
 with c3:
     st.markdown(
-        f"""
-        <div style="
-            padding:14px 18px;
-            border-radius:14px;
-            background:{dir_color}22;
-            border:1px solid {dir_color};
-        ">
-            <div style="font-weight:700; font-size:18px; color:{dir_color};">
-                Sentimiento: {dir_label}
-            </div>
-            <div style="color:#555; margin-top:4px;">
-                NC Net actual: <b>{int(last['NC Net']):,}</b> contratos.
-            </div>
-        </div>
-        """,
+        CARD_HTML.format(
+            color=dir_color,
+            title=f"Sentimiento: {dir_label}",
+            body=f"NC Net actual: <b>{fmt_int(nc_net)}</b> contratos.",
+        ),
         unsafe_allow_html=True
     )
 
 # Tarjeta 2: Intensidad (según % cambio 4 semanas de NC Net)
-int_label, int_color = intensity_from_pct(abs(nc_delta_pct) if not pd.isna(nc_delta_pct) else None)
+int_label, int_color = intensity_from_pct(None if np.isnan(nc_delta_pct) else abs(nc_delta_pct))
 with c4:
     st.markdown(
-        f"""
-        <div style="
-            padding:14px 18px;
-            border-radius:14px;
-            background:{int_color}22;
-            border:1px solid {int_color};
-        ">
-            <div style="font-weight:700; font-size:18px; color:{int_color};">
-                Intensidad: {int_label}
-            </div>
-            <div style="color:#555; margin-top:4px;">
-                Cambio 4 semanas (NC Net): 
-                <b>{'—' if pd.isna(nc_delta_abs) else f'{int(nc_delta_abs):,}'}</b> contratos 
-                ({'—' if pd.isna(nc_delta_pct) else f'{nc_delta_pct:.1f}%'}).
-            </div>
-        </div>
-        """,
+        CARD_HTML.format(
+            color=int_color,
+            title=f"Intensidad: {int_label}",
+            body=(
+                "Cambio 4 semanas (NC Net): "
+                f"<b>{fmt_int(nc_delta_abs)}</b> contratos "
+                f"({'—' if np.isnan(nc_delta_pct) else f'{nc_delta_pct:.1f}%'})."
+            ),
+        ),
         unsafe_allow_html=True
     )
 
-st.caption(f"Última fecha en el rango: {last[COL_DATE].date():%d/%m/%Y}")
+st.caption(f"Última fecha en el rango: {last_date.date():%d/%m/%Y}")
 
 # Fila 2: Totales Long/Short (último dato)
 c5, c6, c7, c8 = st.columns(4)
-c5.metric("NC Long (último)",  f"{int(last[COL_NC_L]):,}")
-c6.metric("NC Short (último)", f"{int(last[COL_NC_S]):,}")
-c7.metric("C Long (último)",   f"{int(last[COL_C_L]):,}")
-c8.metric("C Short (último)",  f"{int(last[COL_C_S]):,}")
-
-# -------------------- Variación mensual (%) de netos --------------------
-df_m = (
-    df_plot.set_index(COL_DATE)[["NC Net", "C Net"]]
-    .resample("M").last()
-    .dropna(how="all")
-)
-
-def pct_change_safe(series: pd.Series) -> pd.Series:
-    prev_m = series.shift(1)
-    pct = (series - prev_m) / prev_m.abs() * 100.0
-    pct = pct.mask((prev_m.abs() < 1e-12) | prev_m.isna())
-    return pct
-
-df_m["NC Net %MoM"] = pct_change_safe(df_m["NC Net"])
-df_m["C Net %MoM"]  = pct_change_safe(df_m["C Net"])
+c5.metric("NC Long (último)",  fmt_int(nc_long))
+c6.metric("NC Short (último)", fmt_int(nc_short))
+c7.metric("C Long (último)",   fmt_int(c_long))
+c8.metric("C Short (último)",  fmt_int(c_short))
+
+# -------------------- Figuras persistentes --------------------
+GL_THRESHOLD = 1000  # con más puntos, las líneas pasan a WebGL (Scattergl); con menos, SVG
+
+def session_figure(key: str, build) -> go.Figure:
+    """Figura guardada en session_state: se arma una vez y en cada rerun solo cambian sus datos."""
+    if key not in st.session_state:
+        st.session_state[key] = build()
+    return st.session_state[key]
+
+def build_nets_figure(trace) -> go.Figure:
+    """Esqueleto del gráfico de netos (una traza por serie, sin datos)."""
+    fig = go.Figure(
+        data=[trace(name=c, mode="lines") for c in ("NC Net", "C Net")],
+        layout=go.Layout(xaxis_title="Fecha", yaxis_title="Contratos (Netos)", legend_title_text="Serie"),
+    )
+    fig.add_hline(y=0, line_dash="dash", opacity=0.5)
+    return fig
+
+# Color de barra por signo: 0 -> negativo, 1 -> positivo (paleta discreta de 2 entradas)
+SIGN_COLORSCALE = [[0, "rgb(200,60,60)"], [1, "rgb(0,150,100)"]]
+
+def bar_signs(pct: np.ndarray) -> np.ndarray:
+    """Código de color (int8) por barra: 1 si el % es >= 0 o NaN, 0 si es negativo."""
+    return (np.nan_to_num(pct) >= 0).astype(np.int8)
+
+def build_mom_figure(name: str, title: str) -> go.Figure:
+    """Esqueleto de un gráfico de barras de variación mensual (%)."""
+    fig = go.Figure(go.Bar(
+        name=name, marker=dict(colorscale=SIGN_COLORSCALE, cmin=0, cmax=1, showscale=False)
+    ))
+    fig.update_layout(
+        title=title, xaxis_title="Mes", yaxis_title="% mensual", bargap=0.15, showlegend=False
+    )
+    fig.add_hline(y=0, line_dash="dash", opacity=0.5)
+    return fig
 
 # -------------------- Tabs --------------------
 tab1, tab2 = st.tabs(["Netos (C vs NC)", "Variación mensual (%)"])
 
 with tab1:
-    fig_nets = px.line(
-        df_plot, x=COL_DATE, y=["NC Net", "C Net"],
-        labels={"value": "Contratos (Netos)", "variable": "Serie", COL_DATE: "Fecha"},
-        title=f"Posiciones Netas – Commercial vs Noncommercial ({sel_years[0]}–{sel_years[1]})"
-    )
-    fig_nets.add_hline(y=0, line_dash="dash", opacity=0.5)
+    # Reducción de puntos cacheada por mercado y años: cambiar de pestaña no la repite
+    df_line = compute_lines(*data_key, sel_market, *sel_years)
+    x_line = df_line[COL_DATE].to_numpy()
+    trace = go.Scattergl if len(df_line) > GL_THRESHOLD else go.Scatter
+    # Una figura por tipo de traza: SVG y WebGL no se pueden intercambiar en sitio
+    fig_nets = session_figure(f"fig_nets_{trace.__name__}", lambda: build_nets_figure(trace))
+    with fig_nets.batch_update():
+        for tr, c in zip(fig_nets.data, ("NC Net", "C Net")):
+            tr.x = x_line
+            tr.y = df_line[c].to_numpy()
+        fig_nets.layout.title.text = (
+            f"Posiciones Netas – Commercial vs Noncommercial ({sel_years[0]}–{sel_years[1]})"
+        )
     st.plotly_chart(fig_nets, use_container_width=True)
 
 with tab2:
+    # Variación mensual (%) de netos: cada columna calcula solo su serie, cacheada
+    # por mercado y años
     cA, cB = st.columns(2)
 
     with cA:
-        base_nc = df_m["NC Net %MoM"]
-        colors_nc = np.where(base_nc.fillna(0) >= 0, "rgb(0,150,100)", "rgb(200,60,60)")
-        fig_nc = go.Figure(go.Bar(x=df_m.index, y=base_nc, marker_color=colors_nc, name="NC Net %MoM"))
-        fig_nc.update_layout(
-            title="No-Commercial: variación mensual de netos (%)",
-            xaxis_title="Mes", yaxis_title="% mensual", bargap=0.15, showlegend=False
-        )
-        fig_nc.add_hline(y=0, line_dash="dash", opacity=0.5)
+        mom_nc = compute_mom(*data_key, sel_market, *sel_years, "NC Net")
+        # float32: Plotly lo envía como array tipado en base64 (y la mitad de bytes)
+        base_nc = mom_nc.to_numpy(dtype=np.float32)
+        sign_nc = bar_signs(base_nc)
+        fig_nc = session_figure("fig_nc", lambda: build_mom_figure(
+            "NC Net %MoM", "No-Commercial: variación mensual de netos (%)"
+        ))
+        fig_nc.update_traces(x=mom_nc.index.to_numpy(), y=base_nc, marker_color=sign_nc)
         st.plotly_chart(fig_nc, use_container_width=True)
 
     with cB:
-        base_c = df_m["C Net %MoM"]
-        colors_c = np.where(base_c.fillna(0) >= 0, "rgb(0,150,100)", "rgb(200,60,60)")
-        fig_c = go.Figure(go.Bar(x=df_m.index, y=base_c, marker_color=colors_c, name="C Net %MoM"))
-        fig_c.update_layout(
-            title="Commercial: variación mensual de netos (%)",
-            xaxis_title="Mes", yaxis_title="% mensual", bargap=0.15, showlegend=False
-        )
-        fig_c.add_hline(y=0, line_dash="dash", opacity=0.5)
+        mom_c = compute_mom(*data_key, sel_market, *sel_years, "C Net")
+        base_c = mom_c.to_numpy(dtype=np.float32)
+        sign_c = bar_signs(base_c)
+        fig_c = session_figure("fig_c", lambda: build_mom_figure(
+            "C Net %MoM", "Commercial: variación mensual de netos (%)"
+        ))
+        fig_c.update_traces(x=mom_c.index.to_numpy(), y=base_c, marker_color=sign_c)
         st.plotly_chart(fig_c, use_container_width=True)
 
     st.caption("Nota: % mensual calculado con el último valor de cada mes. Si el valor previo es 0 o no existe, el % se deja como NaN para evitar distorsiones.")
@@ -0,0 +1,312 @@
+"""Carga, caché y cálculos de los datos COT, separados de la interfaz de Streamlit."""
+import hashlib
+import os
+import re
+import tempfile
+
+import streamlit as st
+import pandas as pd
+import numpy as np
+from pathlib import Path
+
+# -------------------- Columnas esperadas --------------------
+COL_MARKET = "Market and Exchange Names"
+COL_DATE   = "As of Date in Form YYYY-MM-DD"
+COL_NC_L   = "Noncommercial Positions-Long (All)"
+COL_NC_S   = "Noncommercial Positions-Short (All)"
+COL_C_L    = "Commercial Positions-Long (All)"
+COL_C_S    = "Commercial Positions-Short (All)"
+
+# Columnas derivadas que se añaden al cargar
+COL_YEAR   = "_year"
+COL_MONTH  = "_month"  # año*12 + (mes-1): clave entera de mes, creciente con la fecha
+
+# -------------------- Carga de datos --------------------
+DATA_PATH = Path("CME.xlsx")
+CACHE_VERSION = 3  # subir si cambia lo que read_workbook guarda en la caché Parquet
+
+def read_workbook(path: str) -> pd.DataFrame:
+    """Excel -> DataFrame con nombres de columna normalizados y fecha parseada."""
+    try:
+        df = pd.read_excel(path, engine="calamine")
+    except (ImportError, ValueError):
+        # python-calamine no instalado (o pandas < 2.2): se usa openpyxl
+        df = pd.read_excel(path, engine="openpyxl")
+    df.columns = [str(c).replace("\n", " ").strip() for c in df.columns]
+    # calamine ya entrega fechas nativas: solo se parsea si llegaron como texto
+    if COL_DATE in df.columns and not pd.api.types.is_datetime64_any_dtype(df[COL_DATE]):
+        df[COL_DATE] = pd.to_datetime(df[COL_DATE], errors="coerce", dayfirst=True)
+    if COL_MARKET in df.columns:
+        # Categórica desde la lectura: el Parquet la guarda codificada con diccionario
+        df[COL_MARKET] = df[COL_MARKET].astype("category")
+    num_cols = [c for c in (COL_NC_L, COL_NC_S, COL_C_L, COL_C_S) if c in df.columns]
+    nums = df[num_cols].apply(pd.to_numeric, errors="coerce")
+    # Los contratos caben en int32: la mitad de bytes en cada filtro, resta y gráfico.
+    # Columnas con huecos (float por los NaN) se dejan como están.
+    int32_cols = {
+        c: "int32" for c in num_cols
+        if nums[c].dtype.kind in "iu" and nums[c].abs().max() < 2**31
+    }
+    df[num_cols] = nums.astype(int32_cols)
+    return df
+
+def parquet_cache_path(path: str) -> Path:
+    """Ruta del Parquet de caché para `path`, nombrada por el hash de su contenido."""
+    src = Path(path)
+    digest = hashlib.blake2b(src.read_bytes(), digest_size=16).hexdigest()
+    return src.parent / ".cache" / f"{src.stem}-v{CACHE_VERSION}-{digest}.parquet"
+
+@st.cache_resource(max_entries=1)
+def load_data(path: str, mtime: float) -> pd.DataFrame:
+    """Lee el Excel una sola vez; `mtime` entra en la clave de caché para releerlo si cambia.
+
+    El resultado normalizado se guarda como Parquet en `.cache/`, con el hash del
+    archivo en el nombre: los arranques en frío siguientes no vuelven a parsear el
+    XML del .xlsx mientras su contenido no cambie.
+
+    Con cache_resource todas las sesiones comparten el mismo objeto (sin copiarlo
+    en cada rerun): es de solo lectura, nadie debe modificarlo en sitio. Solo se
+    guarda la versión vigente del archivo: al cambiar `mtime`, la anterior se libera.
+    """
+    cache = parquet_cache_path(path)
+    if cache.exists():
+        df = pd.read_parquet(cache, engine="pyarrow")
+    else:
+        df = read_workbook(path)
+        tmp = None
+        try:
+            cache.parent.mkdir(exist_ok=True)
+            # Escritura atómica a un temporal propio: otra sesión nunca ve un Parquet a
+            # medio escribir, y dos procesos en frío no escriben sobre el mismo archivo
+            fd, tmp = tempfile.mkstemp(dir=cache.parent, suffix=".tmp")
+            os.close(fd)
+            df.to_parquet(tmp, engine="pyarrow", compression="zstd")
+            os.replace(tmp, cache)
+            # Snapshots de versiones anteriores del archivo (u otra CACHE_VERSION) ya no
+            # sirven; patrón exacto para no tocar cachés de otro libro con nombre parecido
+            own = re.compile(rf"{re.escape(Path(path).stem)}-v\d+-[0-9a-f]{{32}}\.parquet")
+            for stale in cache.parent.iterdir():
+                if stale != cache and own.fullmatch(stale.name):
+                    stale.unlink(missing_ok=True)
+        except Exception:
+            # La caché es solo una optimización: sin pyarrow, carpeta de solo lectura o
+            # columnas que Arrow no sabe guardar (ArrowInvalid/ArrowTypeError), se sigue
+            # con lo leído del Excel
+            pass
+        finally:
+            if tmp is not None:
+                Path(tmp).unlink(missing_ok=True)
+    pos_cols = [COL_NC_L, COL_NC_S, COL_C_L, COL_C_S]
+    if all(c in df.columns for c in pos_cols):
+        # Netos una sola vez sobre toda la tabla (int32 si las posiciones lo son)
+        pos = df[pos_cols].to_numpy()
+        df["NC Net"] = pos[:, 0] - pos[:, 1]
+        df["C Net"] = pos[:, 2] - pos[:, 3]
+    if COL_DATE in df.columns:
+        # Año precalculado (Int16 admite NaT): filtrar por año no vuelve a descomponer fechas
+        df[COL_YEAR] = df[COL_DATE].dt.year.astype("Int16")
+        df[COL_MONTH] = (df[COL_DATE].dt.year * 12 + df[COL_DATE].dt.month - 1).astype("Int32")
+    if COL_MARKET in df.columns:
+        # Mercado como categoría (ya lo es si viene de read_workbook), filas ordenadas
+        # por mercado y fecha (NaT al final)
+        df[COL_MARKET] = df[COL_MARKET].astype("category")
+        sort_cols = [COL_MARKET, COL_DATE] if COL_DATE in df.columns else [COL_MARKET]
+        df = df.sort_values(sort_cols, kind="stable", ignore_index=True)
+    return df
+
+@st.cache_data
+def get_markets(path: str, mtime: float) -> list[str]:
+    """Lista ordenada de mercados, calculada una vez por versión del archivo."""
+    # Las claves del split ya son los mercados con datos: no hace falta otro recorrido
+    return sorted(split_by_market(path, mtime))
+
+def four_week_change(v: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Cambio frente a 4 reportes antes: absoluto y % (denominador mínimo 1); NaN al inicio."""
+    v = v.astype(np.float64)
+    delta = np.full_like(v, np.nan)
+    pct = np.full_like(v, np.nan)
+    delta[4:] = v[4:] - v[:-4]
+    pct[4:] = delta[4:] / np.maximum(1.0, np.abs(v[:-4])) * 100.0
+    return delta, pct
+
+@st.cache_data
+def get_year_range(path: str, mtime: float) -> tuple[int, int]:
+    """Primer y último año con datos, a partir de la columna de año precalculada."""
+    years = np.unique(load_data(path, mtime)[COL_YEAR].dropna().to_numpy())
+    return int(years[0]), int(years[-1])
+
+@st.cache_resource(max_entries=1)
+def split_by_market(path: str, mtime: float) -> dict[str, pd.DataFrame]:
+    """Un DataFrame por mercado, ya ordenado por fecha; se arma una vez por versión del archivo.
+
+    Compartido entre sesiones como load_data: los recortes por año son vistas de solo lectura.
+    """
+    df = load_data(path, mtime)
+    # Solo las columnas que usa la app: cada slice posterior mueve menos bytes
+    cols = [COL_DATE, COL_MONTH, COL_NC_L, COL_NC_S, COL_C_L, COL_C_S, "NC Net", "C Net"]
+    by_market = {}
+    for m, g in df.groupby(COL_MARKET, observed=True, sort=False):
+        # Sin fechas NaT: los recortes por año y el cambio a 4 reportes solo ven filas fechadas
+        g = g[cols].dropna(subset=[COL_DATE]).reset_index(drop=True)
+        delta, pct = four_week_change(g["NC Net"].to_numpy())
+        by_market[m] = g.assign(**{"NC Net 4w": delta, "NC Net 4w %": pct})
+    return by_market
+
+def slice_years(df_mkt: pd.DataFrame, y0: int, y1: int) -> pd.DataFrame:
+    """Filas de un mercado entre los años y0 e y1 (incluidos).
+
+    `df_mkt` viene ordenado por fecha y sin NaT, así que el rango se recorta
+    con searchsorted y un slice posicional, sin máscara booleana.
+    """
+    dates = df_mkt[COL_DATE].to_numpy()
+    lo, hi = np.searchsorted(dates, [np.datetime64(f"{y0}-01-01"), np.datetime64(f"{y1 + 1}-01-01")])
+    return df_mkt.iloc[lo:hi]
+
+# -------------------- KPIs --------------------
+KPI_COLS = ["NC Net", "C Net", COL_NC_L, COL_NC_S, COL_C_L, COL_C_S, "NC Net 4w", "NC Net 4w %"]
+
+@st.cache_data
+def compute_kpis(path: str, mtime: float, market: str, y0: int, y1: int) -> tuple[np.ndarray, pd.Timestamp]:
+    """Últimas 2 filas de KPI_COLS (como un único ndarray) y última fecha, por mercado y años."""
+    df_in = slice_years(split_by_market(path, mtime)[market], y0, y1)
+    kpi = df_in[KPI_COLS].to_numpy(dtype=np.float64)[-2:]
+    # El cambio a 4 semanas solo cuenta si el reporte de hace 4 semanas cae dentro del rango
+    if len(df_in) < 5:
+        kpi[:, -2:] = np.nan
+    return kpi, df_in[COL_DATE].iloc[-1]
+
+# -------------------- Variación mensual --------------------
+def monthly_last(df_in: pd.DataFrame, cols: list[str]) -> pd.DataFrame:
+    """Último valor no NaN de cada mes (df_in ordenado por fecha, sin NaT), a fin de mes.
+
+    Igual que resample("M").last().dropna(how="all"): solo salen los meses con algún
+    dato en `cols` (un hueco de reportes no deja meses vacíos en medio), y un mes sin
+    dato en una columna queda en NaN solo en esa columna.
+
+    >>> df = pd.DataFrame({
+    ...     COL_DATE: pd.to_datetime(["2020-01-03", "2020-01-24", "2020-02-07", "2020-02-21", "2020-04-03"]),
+    ...     COL_MONTH: [24240, 24240, 24241, 24241, 24243],
+    ...     "NC Net": [100, np.nan, 110, 120, np.nan],
+    ...     "C Net": [-5, -6, np.nan, np.nan, -7],
+    ... })
+    >>> ref = df.set_index(COL_DATE)[["NC Net", "C Net"]].resample("ME").last().dropna(how="all")
+    >>> monthly_last(df, ["NC Net", "C Net"]).equals(ref)
+    True
+    >>> monthly_last(df, ["NC Net", "C Net"])["NC Net"].tolist()
+    [100.0, 120.0, nan]
+    >>> monthly_last(df.iloc[:0], ["NC Net"]).empty
+    True
+    """
+    # Clave de mes precalculada al cargar: un escaneo lineal sobre int32, sin pasar por fechas
+    months = df_in[COL_MONTH].to_numpy(dtype=np.int32)
+    if len(months) == 0:
+        return pd.DataFrame(
+            {c: df_in[c].to_numpy() for c in cols},
+            index=pd.DatetimeIndex([], dtype="datetime64[ns]", name=COL_DATE),
+        )
+    # Por columna: última fila no NaN de cada mes = donde cambia el mes, más la última fila
+    last = {}
+    for c in cols:
+        v = df_in[c].to_numpy()
+        m = months
+        if v.dtype.kind == "f":
+            ok = ~np.isnan(v)
+            v, m = v[ok], m[ok]
+        last_idx = np.flatnonzero(np.append(m[1:] != m[:-1], len(m) > 0))
+        last[c] = (m[last_idx], v[last_idx])
+    # Meses de salida: los que tienen dato en alguna columna (ya ordenados)
+    out = np.unique(np.concatenate([m for m, _ in last.values()]))
+    first_of_month = (out - 1970 * 12).astype("datetime64[M]")
+    month_end = (first_of_month + 1).astype("datetime64[ns]") - np.timedelta64(1, "D")
+    # Columna a columna: cada una queda en su propio buffer contiguo (y conserva su dtype
+    # si no le falta ningún mes), en vez de vistas con stride sobre una matriz 2D
+    data = {}
+    for c, (m, v) in last.items():
+        if len(m) == len(out):
+            data[c] = v
+        else:
+            col = np.full(len(out), np.nan)
+            col[np.searchsorted(out, m)] = v
+            data[c] = col
+    return pd.DataFrame(data, index=pd.DatetimeIndex(month_end, name=COL_DATE))
+
+def pct_change_safe(series: pd.Series) -> pd.Series:
+    """% cambio vs. el valor previo; NaN si el previo es 0 o no existe."""
+    v = series.to_numpy(dtype=np.float64)
+    prev_m = np.empty_like(v)
+    prev_m[:1] = np.nan
+    prev_m[1:] = v[:-1]
+    denom = np.abs(prev_m)
+    # Solo se divide donde el previo es válido; el resto queda en NaN (NaN >= x es False)
+    pct = np.full_like(v, np.nan)
+    np.divide(v - prev_m, denom, out=pct, where=denom >= 1e-12)
+    pct *= 100.0
+    return pd.Series(pct, index=series.index)
+
+@st.cache_data
+def compute_mom(path: str, mtime: float, market: str, y0: int, y1: int, col: str) -> pd.Series:
+    """% de variación mensual del neto `col` (indexado a fin de mes), por mercado y años."""
+    # Los meses se eligen con ambos netos (como el dropna(how="all") original), así
+    # NC y C comparten eje aunque a uno le falte el dato de algún mes
+    df_m = monthly_last(slice_years(split_by_market(path, mtime)[market], y0, y1), ["NC Net", "C Net"])
+    return pct_change_safe(df_m[col]).rename(f"{col} %MoM")
+
+# -------------------- Reducción de puntos (LTTB) --------------------
+MAX_POINTS = 2000  # por encima de esto, las líneas se reducen antes de dibujarlas
+
+def lttb_indices(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    """Índices que conserva Largest-Triangle-Three-Buckets para dibujar `n_out` puntos."""
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    x = x.astype(np.float64)
+    y = y.astype(np.float64)
+    # n_out - 2 cubetas entre el primer y el último punto (que se conservan siempre)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    edges = np.append(edges, n)
+    idx = np.empty(n_out, dtype=np.int64)
+    idx[0], idx[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        cx = x[hi:edges[i + 2]].mean()
+        cy = y[hi:edges[i + 2]].mean()
+        area = np.abs((x[a] - cx) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (cy - y[a]))
+        a = lo + int(np.argmax(np.nan_to_num(area, nan=-1.0)))
+        idx[i + 1] = a
+    return idx
+
+def minmax_lttb_indices(x: np.ndarray, y: np.ndarray, n_out: int, ratio: int = 4) -> np.ndarray:
+    """MinMaxLTTB: preselecciona min y max por cubeta y aplica LTTB sobre esos candidatos.
+
+    Más rápido que LTTB sobre la serie completa cuando es muy larga, y conserva los
+    extremos locales (cada cubeta aporta su mínimo y su máximo como candidatos).
+    """
+    n = len(y)
+    if n <= n_out * ratio:
+        return lttb_indices(x, y, n_out)
+    # Cubetas de igual tamaño entre el primer y el último punto; el relleno repite el
+    # último valor, así que argmin/argmax nunca caen en él salvo en cubetas vacías
+    body = np.nan_to_num(y[1:-1].astype(np.float64), nan=0.0)
+    n_buckets = n_out * ratio // 2
+    size = -(-len(body) // n_buckets)
+    blocks = np.pad(body, (0, size * n_buckets - len(body)), mode="edge").reshape(n_buckets, size)
+    offsets = 1 + np.arange(n_buckets) * size
+    cand = np.concatenate(([0], offsets + blocks.argmin(axis=1), offsets + blocks.argmax(axis=1), [n - 1]))
+    sel = np.unique(np.minimum(cand, n - 1))
+    return sel[lttb_indices(x[sel], y[sel], n_out)]
+
+def downsample_rows(df_in: pd.DataFrame, cols: list[str], n_out: int = MAX_POINTS) -> pd.DataFrame:
+    """Filas a dibujar: unión de los puntos MinMaxLTTB de cada serie (comparten el eje X)."""
+    if len(df_in) <= n_out:
+        return df_in
+    x = df_in[COL_DATE].to_numpy().astype(np.int64)
+    keep = np.unique(np.concatenate([minmax_lttb_indices(x, df_in[c].to_numpy(), n_out) for c in cols]))
+    return df_in.iloc[keep]
+
+@st.cache_data
+def compute_lines(path: str, mtime: float, market: str, y0: int, y1: int) -> pd.DataFrame:
+    """Fecha + netos ya reducidos para el gráfico de líneas, por mercado y años."""
+    cols = ["NC Net", "C Net"]
+    df_in = slice_years(split_by_market(path, mtime)[market], y0, y1)
+    return downsample_rows(df_in[[COL_DATE, *cols]], cols)